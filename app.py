@@ -1,36 +1,148 @@
 # Import packages
-from dash import Dash, html, dash_table, dcc, callback, Output, Input
+from dash import Dash, dash_table, dcc, callback, Output, Input
+from dash.dash_table.Format import Format, Scheme
+import numpy as np
 import pandas as pd
-import plotly.express as px
+import pyarrow as pa
+import plotly.graph_objects as go
 import dash_mantine_components as dmc
-import json
+from collections import namedtuple
+import contextlib
+import os
+import orjson
+from pathlib import Path
+from numba import njit, types
+import re
+import warnings
 
 
 # load the dashboard
-SETTINGS = json.load(open("settings.json", "r"))
+SETTINGS = orjson.loads(Path("settings.json").read_bytes())
+
+# above this many transactions, the transactions over time are plotted as daily totals
+MAX_BARS = 5000
+
+# everything clean_description needs for an account, compiled once at startup
+CleaningConfig = namedtuple("CleaningConfig", ["combined_regex", "category_regex", "category_map"])
+
+
+def make_cleaning_config(account_settings):
+    """Compile an account's description patterns and custom categories."""
+
+    # fuse the description patterns into a single regex
+    combined_regex = re.compile(
+        "|".join(f"(?:{pattern})" for pattern in account_settings["patterns"])
+    )
+
+    # match any of the custom categories with a single capturing alternation
+    category_map = account_settings["customCategories"]
+    category_regex = re.compile(
+        "(" + "|".join(re.escape(category) for category in category_map) + ")"
+    )
+
+    return CleaningConfig(combined_regex, category_regex, category_map)
+
+
+CLEANING_CONFIGS = {
+    account_type: make_cleaning_config(account_settings)
+    for account_type, account_settings in SETTINGS.items()
+}
 
 
 def load_data(account_settings):
     # TODO: We should really only be looking at expenses from checkings, and additionally load in the savings account for income
-    df = pd.read_csv(account_settings["filePath"], header=None)
 
-    # give the columns names, and drop the columns we don't need (any that start with DROP)
-    df.columns = account_settings["columns"]
-    to_drop = [col for col in df.columns if col.startswith("DROP")]
-    df.drop(to_drop, axis=1, inplace=True)
+    # give the columns names, and only read the columns we need (any that don't start with DROP)
+    columns = account_settings["columns"]
+    to_keep = [i for i, col in enumerate(columns) if not col.startswith("DROP")]
+    names = [columns[i] for i in to_keep]
+    dtypes = {"Amount": "float32", "Description": "string[pyarrow]"}
+
+    df = pd.read_csv(
+        account_settings["filePath"],
+        header=None,
+        names=names,
+        usecols=to_keep,
+        dtype={col: dtype for col, dtype in dtypes.items() if col in names},
+        parse_dates=["Date"] if "Date" in names else False,
+        engine="pyarrow",
+    )
 
     if "Date" in df.columns:
-        # convert the date column to datetime
-        df["Date"] = pd.to_datetime(df["Date"])
+        # transactions are daily, so nanosecond resolution is wasted
+        # (milliseconds, since that is the coarsest unit the parquet cache can store)
+        df["Date"] = df["Date"].astype("datetime64[ms]")
 
-        # sort the dataframe by date
-        df.sort_values(by="Date", inplace=True)
+        # sort the dataframe by date, once, with a stable sort straight on the datetime values
+        order = np.argsort(df["Date"].values, kind="stable")
+        df = df.take(order).reset_index(drop=True)
     else:
         print("Expected a Date column, but none was found.")
 
     return df
 
 
+@njit(
+    types.Tuple((types.int64[:], types.uint8[:]))(types.int64[:], types.uint8[:], types.int64),
+    cache=True,
+)
+def truncate_utf8(offsets, data, max_chars):
+    """
+    Cut each UTF-8 string in an Arrow string layout (offsets + data buffers) down to max_chars
+    characters, adding ... to the strings that were cut. Returns the new offsets and data.
+    """
+
+    n = offsets.size - 1
+    out_offsets = np.empty(n + 1, dtype=np.int64)
+    out_data = np.empty(data.size + 3 * n, dtype=np.uint8)
+    out_offsets[0] = 0
+    pos = 0
+    for i in range(n):
+        start, end = offsets[i], offsets[i + 1]
+
+        # find the byte where the character after max_chars starts (skipping continuation bytes)
+        cut = end
+        chars = 0
+        for j in range(start, end):
+            if (data[j] & 0xC0) != 0x80:
+                if chars == max_chars:
+                    cut = j
+                    break
+                chars += 1
+
+        out_data[pos : pos + cut - start] = data[start:cut]
+        pos += cut - start
+        if cut < end:
+            out_data[pos : pos + 3] = ord(".")
+            pos += 3
+        out_offsets[i + 1] = pos
+
+    return out_offsets, out_data[:pos]
+
+
+def truncate30(s):
+    """Cut the strings in a series down to 30 characters, adding ... to the ones that were cut."""
+
+    arr = pa.array(s, type=pa.large_string())
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    # (the validity bitmap is rebuilt from arr.is_valid(), since it can be offset like the others)
+    _, offsets, data = arr.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[arr.offset : arr.offset + len(arr) + 1]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, dtype=np.uint8)
+
+    out_offsets, out_data = truncate_utf8(offsets, data, 30)
+    truncated = pa.LargeStringArray.from_buffers(
+        len(arr),
+        pa.py_buffer(out_offsets),
+        pa.py_buffer(out_data),
+        arr.is_valid().buffers()[1] if arr.null_count else None,
+        arr.null_count,
+    )
+
+    return pd.Series(pd.arrays.ArrowStringArray(truncated), index=s.index, name=s.name)
+
+
 def clean_description(df, account_type):
     """
     Call this function to clean the description column of the dataframe.
@@ -43,140 +155,250 @@ def clean_description(df, account_type):
         return df
 
     descr_clean = df.copy()
+    config = CLEANING_CONFIGS[account_type]
 
-    # remove all of these patterns from the description column
-    patterns = SETTINGS[account_type]["patterns"]
-    for pattern in patterns:
-        print(pattern)
+    # remove all of these patterns from the description column in a single pass
+    # (pass the compiled regex, so the settings patterns keep python re semantics, and silence
+    # pandas' warning that this skips pyarrow's own regex engine)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", pd.errors.PerformanceWarning)
         descr_clean["Description"] = (
-            descr_clean["Description"].str.replace(pattern, "", regex=True).str.strip()
+            descr_clean["Description"]
+            .str.replace(config.combined_regex, "", regex=True)
+            .str.strip()
         )
 
-    custom_categories = SETTINGS[account_type]["customCategories"]
-
-    # replace the custom categories
-    for custom_category in custom_categories:
-        # if the custom category is in the description, replace it
-        descr_clean.loc[
-            descr_clean["Description"].str.contains(custom_category), "Description"
-        ] = custom_categories[custom_category]
+    # replace the custom categories, if one of them is in the description
+    matched = descr_clean["Description"].str.extract(config.category_regex, expand=False)
+    mapped = matched.map(config.category_map)
+    descr_clean["Description"] = mapped.where(mapped.notna(), descr_clean["Description"])
 
     # if the description is over 30 characters, cut it off and add ...
-    descr_clean["Description"] = descr_clean["Description"].apply(
-        lambda x: x[:30] + "..." if len(x) > 30 else x
-    )
+    descr_clean["Description"] = truncate30(descr_clean["Description"])
+
+    # the cleaned descriptions repeat a lot, so store them as categories for fast grouping
+    descr_clean["Description"] = descr_clean["Description"].astype("category")
 
     return descr_clean
 
 
-def transactions_over_time(checking, savings):
-    """Call this function to plot the transactions over time."""
+def transactions_over_time(c_clean, s_clean):
+    """
+    Call this function to plot the transactions over time.
 
-    # clean the description column
-    c_clean = clean_description(checking, "checking")
-    c_clean["account"] = "checking"
-    s_clean = clean_description(savings, "savings")
-    s_clean["account"] = "savings"
+    c_clean and s_clean are the checking and savings dataframes, already passed through clean_description
+    and sorted by date (as load_data returns them)
+    """
 
     # join checking and savings, ignoring transfers between accounts
     # - income comes from positive savings transactions
     # - expenses come from negative checking transactions
-    to_plot = pd.concat(
-        [
-            c_clean[c_clean["Amount"] < 0],  # grab expenses from checking
-            s_clean[s_clean["Amount"] > 0],  # grab income from savings
-        ]
-    )
-
-    # Assign colors based on transaction values
-    to_plot["Color"] = to_plot["Amount"].apply(lambda x: "green" if x >= 0 else "red")
-
-    # sort by date
-    to_plot.sort_values(by="Date", inplace=True)
+    c_mask = c_clean["Amount"].values < 0  # grab expenses from checking
+    s_mask = s_clean["Amount"].values > 0  # grab income from savings
 
-    fig = px.bar(
-        to_plot,
-        x="Date",
-        y="Amount",
-        color="Color",
-        title="Transactions Over Time",
-        hover_data=["Description"],
-        color_discrete_map={"green": "green", "red": "red"},
+    # both accounts are already sorted by date, so merge them instead of sorting again
+    # (ties keep checking first, like a stable sort would)
+    pos = np.searchsorted(
+        c_clean["Date"].values[c_mask], s_clean["Date"].values[s_mask], side="right"
+    )
+    to_plot = pd.DataFrame(
+        {
+            col: np.insert(c_clean[col].to_numpy()[c_mask], pos, s_clean[col].to_numpy()[s_mask])
+            for col in ["Date", "Amount", "Description"]
+        }
     )
 
-    # make hover only show the description
-    fig.update_traces(
-        hovertemplate="<br>".join(["Date: %{x}", "Amount: %{y}", "Description: %{customdata[0]}"])
+    # with a long history, roll the transactions up into daily income and expense bars
+    if len(to_plot) > MAX_BARS:
+        to_plot = (
+            to_plot.groupby(
+                [to_plot["Date"].dt.floor("D"), (to_plot["Amount"] >= 0).rename("Income")]
+            )
+            .agg(Amount=("Amount", "sum"), Description=("Description", "size"))
+            .reset_index()
+        )
+        to_plot["Description"] = to_plot["Description"].astype(str) + " transactions"
+
+    # Assign colors based on transaction values, by indexing with the sign instead of branching
+    colors = np.array(["red", "green"])[(to_plot["Amount"].values >= 0).view(np.int8)]
+
+    fig = go.Figure(
+        go.Bar(
+            x=to_plot["Date"].values,
+            y=to_plot["Amount"].values,
+            marker_color=colors,
+            customdata=to_plot["Description"].values[:, None],
+            # make hover only show the description
+            hovertemplate="<br>".join(
+                ["Date: %{x}", "Amount: %{y:.2f}", "Description: %{customdata[0]}"]
+            )
+            + "<extra></extra>",
+        )
     )
 
+    # stack bars on the same date, like plotly express does
+    fig.update_layout(title="Transactions Over Time", barmode="relative")
+
     # remove the legend
     fig.update_layout(showlegend=False)
 
     return fig
 
 
-def description_pie_chart(df, type="+", legend=False):
-    """Call this function to plot the description pie chart, with the option to filter by type."""
+@njit(cache=True)
+def sum_by_code(codes, amounts, n_codes):
+    """Sum the amounts for each integer code, skipping missing (negative) codes."""
+
+    totals = np.zeros(n_codes)
+    for i in range(codes.size):
+        if codes[i] >= 0:
+            totals[codes[i]] += amounts[i]
+
+    return totals
+
+
+def serialize_figure(fig):
+    """
+    Convert a figure to a plain dict once, so Dash can send it without walking the figure
+    (and its numpy arrays) again on every page load.
+    """
+
+    return orjson.loads(fig.to_json())
+
+
+def description_pie_chart(clean_df, type="+", legend=False):
+    """
+    Call this function to plot the description pie chart, with the option to filter by type.
+
+    clean_df should already be passed through clean_description
+    """
+
+    amounts = clean_df["Amount"].values
+    descriptions = clean_df["Description"].values
 
-    # clean the description column
     if type == "+":
-        to_plot = clean_description(df, "savings")
-        to_plot = to_plot[to_plot["Amount"] > 0]
+        mask = amounts > 0
+        amounts = amounts[mask]
         title = "Income by Category"
     elif type == "-":
-        to_plot = clean_description(df, "checking")
-        to_plot = to_plot[to_plot["Amount"] < 0]
-        to_plot["Amount"] *= -1
+        mask = amounts < 0
+        amounts = -amounts[mask]
         title = "Expenses by Category"
 
     # get the top 10 descriptions by total value
-    to_plot = (
-        to_plot.groupby("Description")
-        .sum("Amount")
-        .reset_index()
-        .rename(columns={"Amount": "Total Amount"})
-        .sort_values(by="Total Amount", ascending=False)
-        .head(10)
-    )
-
-    fig = px.pie(
-        to_plot,
-        values="Total Amount",
-        names="Description",
-        title=title,
-        hover_data=["Description"],
-    )
-
-    # make hover only show the description
-    fig.update_traces(
-        hovertemplate="<br>".join(["Description: %{label}", "Total Amount: %{value}"])
+    codes, descriptions = pd.factorize(descriptions[mask])
+    totals = sum_by_code(codes.astype(np.int64), amounts.astype(np.float64), descriptions.size)
+    # select the top 10 without sorting every total, then sort just those
+    top = np.argpartition(-totals, 10)[:10] if totals.size > 10 else np.arange(totals.size)
+    top = top[np.argsort(-totals[top], kind="stable")]
+    to_plot = pd.DataFrame({"Description": descriptions[top], "Total Amount": totals[top]})
+
+    fig = go.Figure(
+        go.Pie(
+            labels=to_plot["Description"].values,
+            values=to_plot["Total Amount"].values,
+            # make hover only show the description
+            hovertemplate="<br>".join(["Description: %{label}", "Total Amount: %{value:.2f}"])
+            + "<extra></extra>",
+        )
     )
+    fig.update_layout(title=title)
 
     # toggle legend
     fig.update_layout(showlegend=legend)
 
-    return dcc.Graph(figure=fig, id=f"{type}-pie-chart")
+    return dcc.Graph(figure=serialize_figure(fig), id=f"{type}-pie-chart")
 
 
 def create_table(df):
-    columns, values = df.columns, df.values
-    header = [html.Tr([html.Th(col) for col in columns])]
-    rows = [
-        html.Tr(
-            [html.Td(cell) for cell in row],
-            style={"background-color": "white" if i % 2 == 0 else "lightgray"},
-        )
-        for i, row in enumerate(values)
+    # show amounts to the cent, since they are stored as float32
+    numeric = {"type": "numeric", "format": Format(precision=2, scheme=Scheme.fixed)}
+    columns = [
+        {"name": col, "id": col, **(numeric if pd.api.types.is_float_dtype(df[col]) else {})}
+        for col in df.columns
     ]
-    table = [html.Thead(header), html.Tbody(rows)]
 
-    table = html.Table(table)
+    table = dash_table.DataTable(
+        data=df.to_dict("records"),
+        columns=columns,
+        style_data={"backgroundColor": "white"},
+        style_data_conditional=[{"if": {"row_index": "odd"}, "backgroundColor": "lightgray"}],
+    )
 
     return table
 
 
-checking = load_data(SETTINGS["checking"])
-savings = load_data(SETTINGS["savings"])
+def write_cache(df, cache):
+    """
+    Write a dataframe to a parquet cache file through a temporary sibling file, so an interrupted
+    write never leaves a truncated cache behind.
+    """
+
+    tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+    try:
+        df.to_parquet(tmp, compression="zstd")
+        os.replace(tmp, cache)
+    finally:
+        with contextlib.suppress(OSError):
+            tmp.unlink(missing_ok=True)
+
+
+def load_account(account_type):
+    """
+    Call this function to load an account's transactions, along with a copy passed through
+    clean_description.
+
+    Both are cached as parquet files next to the account's CSV, and reused for as long as they are
+    newer than the CSV, settings.json and this file.
+    """
+
+    account_settings = SETTINGS[account_type]
+    src = Path(account_settings["filePath"])
+    raw_cache = src.with_suffix(".parquet")
+    clean_cache = src.with_suffix(".cleaned.parquet")
+
+    inputs = [src, Path("settings.json"), Path(__file__)]
+    newest_input = max(path.stat().st_mtime for path in inputs)
+    if all(
+        cache.exists() and cache.stat().st_mtime >= newest_input
+        for cache in [raw_cache, clean_cache]
+    ):
+        try:
+            df = pd.read_parquet(raw_cache)
+            df_clean = pd.read_parquet(clean_cache)
+        except (OSError, pa.ArrowException) as e:
+            print(f"Could not read the parquet cache for {account_type} ({e}), rebuilding it.")
+        else:
+            # parquet doesn't remember pyarrow string storage, so match what a fresh load returns
+            if "Description" in df.columns:
+                df["Description"] = df["Description"].astype("string[pyarrow]")
+                df_clean["Description"] = (
+                    df_clean["Description"].astype("string[pyarrow]").astype("category")
+                )
+
+            return df, df_clean
+
+    df = load_data(account_settings)
+    df_clean = clean_description(df, account_type)
+
+    # the cache is only an optimization, so keep going without it if it can't be written
+    try:
+        write_cache(df, raw_cache)
+        write_cache(df_clean, clean_cache)
+    except (OSError, pa.ArrowException) as e:
+        print(f"Could not write the parquet cache for {account_type} ({e}), continuing without it.")
+
+    return df, df_clean
+
+
+# clean the description columns once, and share them between all of the figures
+checking, checking_clean = load_account("checking")
+savings, savings_clean = load_account("savings")
+
+# the figures never change, so build them once per process
+transactions_figure = serialize_figure(transactions_over_time(checking_clean, savings_clean))
+income_pie_chart = description_pie_chart(savings_clean, type="+", legend=True)
+expenses_pie_chart = description_pie_chart(checking_clean, type="-", legend=True)
 
 # Initialize the app - incorporate css
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
@@ -210,14 +432,14 @@ app.layout = dmc.Container(
                 dmc.Col(
                     [
                         dcc.Graph(
-                            figure=transactions_over_time(checking, savings),
+                            figure=transactions_figure,
                             id="graph-placeholder",
                         )
                     ],
                     span=12,
                 ),
-                dmc.Col([description_pie_chart(savings, type="+", legend=True)], span=6),
-                dmc.Col([description_pie_chart(checking, type="-", legend=True)], span=6),
+                dmc.Col([income_pie_chart], span=6),
+                dmc.Col([expenses_pie_chart], span=6),
             ]
         ),
     ],